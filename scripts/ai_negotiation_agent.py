@@ -9,7 +9,7 @@ import os
 import sqlite3
 import requests
 from datetime import datetime, UTC, timedelta
-from typing import Dict, Optional, List, Tuple
+from typing import Dict, Optional, List, NamedTuple, Tuple
 from dataclasses import dataclass, asdict
 import logging
 
@@ -37,6 +37,18 @@ class BuyerProfile:
     tags: List[str]  # ["high_value", "price_sensitive", "quick_decider", etc.]
 
 
+class HistoryRow(NamedTuple):
+    id: int
+    negotiation_id: str
+    round_number: int
+    actor: str
+    action: str
+    price: Optional[float]
+    message: Optional[str]
+    ai_reasoning: Optional[str]
+    created_at: str
+
+
 @dataclass
 class NegotiationContext:
     negotiation_id: str
@@ -49,7 +61,7 @@ class NegotiationContext:
     offered_price: float
     quantity: int
     round_number: int
-    history: List[Dict]
+    history: List[HistoryRow]
     market_conditions: Dict
 
 
@@ -336,7 +348,7 @@ Maximize successful deals while maintaining fair prices. Balance between:
 - Negotiation success rate: {ctx.market_conditions.get('negotiation_success_rate', 50)}%
 
 ## NEGOTIATION HISTORY
-{json.dumps(ctx.history[-5:], indent=2) if ctx.history else "First offer"}
+{json.dumps([row._asdict() for row in ctx.history[-5:]], indent=2) if ctx.history else "First offer"}
 
 ## STRATEGY PERFORMANCE (what worked before)
 {json.dumps(strategy_perf, indent=2) if strategy_perf else "No data yet"}
@@ -10,14 +10,14 @@ import sys
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
 from datetime import datetime, UTC
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
 from flask_cors import CORS
 from dataclasses import asdict
 
 from market_intelligence import MarketIntelligence
 from dynamic_pricing import DynamicPricingAI
 from decision_engine import EconomicDecisionEngine, JobRequest
-from payment_service import get_payment_service, PaymentRequirement
+from payment_service import get_payment_service, PaymentRequirement, to_json_bytes
 from negotiation_engine_ai import get_ai_negotiation_engine as get_negotiation_engine
 from dashboard_api import dashboard_api
 
@@ -109,7 +109,7 @@ def get_payment_requirements():
     method = d.get("method", "GET")
     try:
         req = payment_service.create_payment_requirements(service_id, endpoint, method)
-        return jsonify(asdict(req))
+        return Response(to_json_bytes(req), mimetype="application/json")
     except ValueError as e:
         return jsonify({"error": str(e)}), 400
 
@@ -123,7 +123,7 @@ def verify_payment():
     if not payment_header:
         return jsonify({"error": "Missing payment header"}), 400
     result = payment_service.verify_x402_payment(service_id, endpoint, payment_header)
-    return jsonify(asdict(result))
+    return Response(to_json_bytes(result), mimetype="application/json")
 
 
 @app.route("/api/payment/verify-token", methods=["POST"])
@@ -134,7 +134,30 @@ def verify_token_gating():
     if not wallet_address:
         return jsonify({"error": "Missing wallet_address"}), 400
     result = payment_service.verify_token_gating(service_id, wallet_address)
-    return jsonify(asdict(result))
+    return Response(to_json_bytes(result), mimetype="application/json")
+
+
+@app.route("/api/gateway/authorize", methods=["POST"])
+def gateway_authorize():
+    d = request.json
+    service_id = d.get("service_id", "oracle_sentinel")
+    endpoint = d.get("endpoint", "/api/v1/signal")
+    method = d.get("method", "GET")
+    wallet_address = d.get("wallet_address")
+    payment_header = d.get("payment")
+    result = {"token_holder": None, "payment_result": None, "requirements": None}
+    if wallet_address:
+        result["token_holder"] = payment_service.verify_token_gating(service_id, wallet_address)
+        if result["token_holder"].success:
+            return Response(to_json_bytes(result), mimetype="application/json")
+    if payment_header:
+        result["payment_result"] = payment_service.verify_x402_payment(service_id, endpoint, payment_header)
+        return Response(to_json_bytes(result), mimetype="application/json")
+    try:
+        result["requirements"] = payment_service.create_payment_requirements(service_id, endpoint, method)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return Response(to_json_bytes(result), mimetype="application/json")
 
 
 @app.route("/api/negotiate/start", methods=["POST"])
@@ -152,7 +175,9 @@ def start_negotiation():
             offered_price=float(d["offered_price"]),
             quantity=int(d.get("quantity", 1))
         )
-        return jsonify(asdict(resp))
+        return Response(to_json_bytes(resp), mimetype="application/json")
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -169,7 +194,7 @@ def respond_negotiation(negotiation_id):
             action=action,
             new_offer=float(d["new_offer"]) if d.get("new_offer") else None
         )
-        return jsonify(asdict(resp))
+        return Response(to_json_bytes(resp), mimetype="application/json")
     except ValueError as e:
         return jsonify({"error": str(e)}), 400
     except Exception as e:
@@ -845,7 +845,7 @@ if __name__ == "__main__":
 # PURCHASE & ACCESS MANAGEMENT (Real x402 Payment)
 # ═══════════════════════════════════════════════════════════════
 
-from payment_service import get_payment_service, PaymentService
+from payment_service import get_payment_service, PaymentService, to_micro
 
 @dashboard_api.route('/buyer/purchase/initiate', methods=['POST'])
 @auth_required
@@ -909,7 +909,7 @@ def initiate_purchase():
     
     # Get x402 payment requirements from payment service
     ps = get_payment_service()
-    price_micro = int(price * 1_000_000)  # Convert to micro-units (USDC has 6 decimals)
+    price_micro = to_micro(price)
     
     # x402 payment requirements
     x402_requirements = {
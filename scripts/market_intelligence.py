@@ -6,6 +6,10 @@ Sentinel Economic — Market Intelligence Module
 import json
 import sqlite3
 import os
+import atexit
+import threading
+import time
+from collections import deque
 from datetime import datetime, timedelta
 from typing import Dict, List, Optional
 from dataclasses import dataclass
@@ -16,6 +20,65 @@ logger = logging.getLogger("market_intelligence")
 
 DB_PATH = os.path.expanduser("~/sentinel-economic/data/sentinel_economic.db")
 
+SCHEMA_SQL = """
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS transactions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    tx_hash TEXT UNIQUE,
+    service_type TEXT NOT NULL,
+    seller_id TEXT NOT NULL,
+    buyer_id TEXT NOT NULL,
+    price REAL NOT NULL,
+    currency TEXT DEFAULT 'USDC',
+    status TEXT DEFAULT 'completed',
+    timestamp TEXT NOT NULL,
+    source TEXT DEFAULT 'internal',
+    metadata TEXT,
+    created_at TEXT DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS providers (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    agent_id TEXT UNIQUE NOT NULL,
+    service_types TEXT,
+    total_transactions INTEGER DEFAULT 0,
+    total_volume REAL DEFAULT 0,
+    success_rate REAL DEFAULT 1.0,
+    avg_rating REAL DEFAULT 5.0,
+    trust_score REAL,
+    last_active TEXT,
+    created_at TEXT DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS price_history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    service_type TEXT NOT NULL,
+    price REAL NOT NULL,
+    timestamp TEXT NOT NULL,
+    source TEXT
+);
+
+CREATE INDEX IF NOT EXISTS idx_transactions_type_time ON transactions(service_type, timestamp);
+
+COMMIT;
+"""
+
+# Schema is created once per process
+_schema_initialized = False
+_schema_lock = threading.Lock()
+
+INSERT_TRANSACTION_SQL = """
+    INSERT INTO transactions 
+    (tx_hash, service_type, seller_id, buyer_id, price, currency, timestamp, source, metadata)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+INSERT_PRICE_HISTORY_SQL = """
+    INSERT INTO price_history (service_type, price, timestamp, source)
+    VALUES (?, ?, ?, ?)
+"""
+
 
 @dataclass
 class MarketRate:
@@ -30,6 +93,93 @@ class MarketRate:
     last_updated: str
 
 
+class TransactionWriter:
+    """Background writer that group-commits queued transactions"""
+    
+    FLUSH_INTERVAL = 0.05  # seconds
+    RETRY_INTERVAL = 1.0  # seconds before re-flushing rows kept after an OperationalError
+    
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._pending = deque()
+        self._wake = threading.Event()
+        self._flush_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._thread = None
+    
+    def submit(self, row: tuple):
+        """Queue a transactions row; it is written on the next flush"""
+        self._pending.append(row)
+        if self._thread is None:
+            with self._start_lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="transaction-writer",
+                                                    daemon=True)
+                    self._thread.start()
+        self._wake.set()
+    
+    def _run(self):
+        while True:
+            try:
+                self._wake.wait()
+                time.sleep(self.FLUSH_INTERVAL)
+                self._wake.clear()
+                if not self.flush():
+                    time.sleep(self.RETRY_INTERVAL)
+                    self._wake.set()
+            except Exception as e:
+                # Never let one bad flush stop the writer; queued rows stay queued
+                logger.error(f"Transaction writer error: {e}")
+    
+    def flush(self) -> bool:
+        """
+        Write all queued rows in a single transaction.
+        Rows that can never be stored are logged and skipped. On an
+        OperationalError (e.g. database is locked) the whole batch is put
+        back for the next flush and False is returned.
+        """
+        with self._flush_lock:
+            rows = []
+            while self._pending:
+                rows.append(self._pending.popleft())
+            if not rows:
+                return True
+            
+            conn = None
+            try:
+                conn = sqlite3.connect(self.db_path)
+                history = []
+                for row in rows:
+                    try:
+                        conn.execute(INSERT_TRANSACTION_SQL, row)
+                    except sqlite3.IntegrityError:
+                        continue  # Duplicate tx_hash
+                    except sqlite3.OperationalError:
+                        raise
+                    except Exception as e:
+                        logger.error(f"Dropping unstorable transaction {row[0]!r}: {e}")
+                        continue
+                    history.append((row[1], row[4], row[6], row[7]))
+                conn.executemany(INSERT_PRICE_HISTORY_SQL, history)
+                conn.commit()
+            except sqlite3.OperationalError as e:
+                if conn is not None:
+                    conn.rollback()
+                self._pending.extendleft(reversed(rows))
+                logger.warning(f"Deferred {len(rows)} transactions: {e}")
+                return False
+            except sqlite3.Error as e:
+                logger.error(f"Failed to flush {len(rows)} transactions: {e}")
+            finally:
+                if conn is not None:
+                    conn.close()
+            return True
+
+
+_writer = TransactionWriter(DB_PATH)
+atexit.register(_writer.flush)
+
+
 class MarketIntelligence:
     def __init__(self, agent_id: Optional[str] = None):
         self.agent_id = agent_id
@@ -37,81 +187,48 @@ class MarketIntelligence:
         self._ensure_db()
         
     def _ensure_db(self):
-        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS transactions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                tx_hash TEXT UNIQUE,
-                service_type TEXT NOT NULL,
-                seller_id TEXT NOT NULL,
-                buyer_id TEXT NOT NULL,
-                price REAL NOT NULL,
-                currency TEXT DEFAULT 'USDC',
-                status TEXT DEFAULT 'completed',
-                timestamp TEXT NOT NULL,
-                source TEXT DEFAULT 'internal',
-                metadata TEXT,
-                created_at TEXT DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS providers (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                agent_id TEXT UNIQUE NOT NULL,
-                service_types TEXT,
-                total_transactions INTEGER DEFAULT 0,
-                total_volume REAL DEFAULT 0,
-                success_rate REAL DEFAULT 1.0,
-                avg_rating REAL DEFAULT 5.0,
-                trust_score REAL,
-                last_active TEXT,
-                created_at TEXT DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS price_history (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                service_type TEXT NOT NULL,
-                price REAL NOT NULL,
-                timestamp TEXT NOT NULL,
-                source TEXT
-            )
-        """)
-        
-        conn.commit()
-        conn.close()
+        global _schema_initialized
+        if _schema_initialized:
+            return
+        with _schema_lock:
+            if _schema_initialized:
+                return
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            conn = sqlite3.connect(self.db_path)
+            conn.executescript(SCHEMA_SQL)
+            conn.close()
+            _schema_initialized = True
         logger.info(f"Database initialized at {self.db_path}")
     
-    def _get_db(self):
+    def _get_db(self, row_factory=sqlite3.Row):
         conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
+        conn.row_factory = row_factory
         return conn
     
     def record_transaction(self, service_type: str, seller_id: str, buyer_id: str, 
                           price: float, currency: str = "USDC", tx_hash: str = None,
-                          source: str = "internal", metadata: Dict = None) -> int:
-        conn = self._get_db()
-        cursor = conn.cursor()
+                          source: str = "internal", metadata: Dict = None,
+                          synchronous: bool = True) -> int:
+        """
+        Record a completed transaction.
+        With synchronous=False the row is queued for the background writer
+        and 0 is returned instead of a row id; call flush() to force it out.
+        """
         tx_hash = tx_hash or f"internal_{datetime.utcnow().timestamp()}"
         timestamp = datetime.utcnow().isoformat()
+        row = (tx_hash, service_type, seller_id, buyer_id, price, currency, 
+               timestamp, source, json.dumps(metadata, separators=(",", ":")) if metadata else None)
+        
+        if not synchronous:
+            _writer.submit(row)
+            return 0
+        
+        conn = self._get_db()
+        cursor = conn.cursor()
         
         try:
-            cursor.execute("""
-                INSERT INTO transactions 
-                (tx_hash, service_type, seller_id, buyer_id, price, currency, timestamp, source, metadata)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (tx_hash, service_type, seller_id, buyer_id, price, currency, 
-                  timestamp, source, json.dumps(metadata) if metadata else None))
-            
-            cursor.execute("""
-                INSERT INTO price_history (service_type, price, timestamp, source)
-                VALUES (?, ?, ?, ?)
-            """, (service_type, price, timestamp, source))
+            cursor.execute(INSERT_TRANSACTION_SQL, row)
+            cursor.execute(INSERT_PRICE_HISTORY_SQL, (service_type, price, timestamp, source))
             
             conn.commit()
             return cursor.lastrowid
@@ -120,62 +237,56 @@ class MarketIntelligence:
         finally:
             conn.close()
     
+    def flush(self):
+        """Write any transactions still queued by record_transaction(synchronous=False)"""
+        _writer.flush()
+    
     def get_market_rate(self, service_type: str, lookback_hours: int = 168) -> MarketRate:
-        conn = self._get_db()
+        conn = self._get_db(row_factory=None)
         cursor = conn.cursor()
-        cutoff = (datetime.utcnow() - timedelta(hours=lookback_hours)).isoformat()
+        now = datetime.utcnow()
+        cutoff = (now - timedelta(hours=lookback_hours)).isoformat()
+        day = (now - timedelta(hours=24)).isoformat()
+        w1 = (now - timedelta(days=7)).isoformat()
+        w2 = (now - timedelta(days=14)).isoformat()
         
+        # One pass over the widest window: lookback stats, 24h demand, and both trend weeks
         cursor.execute("""
-            SELECT COUNT(*) as count, AVG(price) as avg_price,
-                   MIN(price) as min_price, MAX(price) as max_price
-            FROM transactions WHERE service_type = ? AND timestamp > ?
-        """, (service_type, cutoff))
+            SELECT COUNT(CASE WHEN timestamp > :cutoff THEN 1 END) as count,
+                   AVG(CASE WHEN timestamp > :cutoff THEN price END) as avg_price,
+                   MIN(CASE WHEN timestamp > :cutoff THEN price END) as min_price,
+                   MAX(CASE WHEN timestamp > :cutoff THEN price END) as max_price,
+                   COUNT(CASE WHEN timestamp > :day THEN 1 END) as recent,
+                   AVG(CASE WHEN timestamp > :w1 THEN price END) as a1,
+                   AVG(CASE WHEN timestamp > :w2 AND timestamp <= :w1 THEN price END) as a2
+            FROM transactions WHERE service_type = :service_type AND timestamp > MIN(:cutoff, :w2)
+        """, {"service_type": service_type, "cutoff": cutoff, "day": day, "w1": w1, "w2": w2})
         
-        stats = cursor.fetchone()
+        count, avg_p, min_p, max_p, recent, a1, a2 = cursor.fetchone()
         
-        if not stats or stats["count"] == 0:
+        if count == 0:
             conn.close()
             return MarketRate(service_type, 0.01, 0.01, 0.01, 0.01, 0, 1.0, "unknown", 
                             datetime.utcnow().isoformat())
         
         cursor.execute("""
             SELECT price FROM transactions
-            WHERE service_type = ? AND timestamp > ? ORDER BY price
-        """, (service_type, cutoff))
-        prices = [r["price"] for r in cursor.fetchall()]
-        median = prices[len(prices)//2] if prices else 0.01
-        
-        cursor.execute("""
-            SELECT COUNT(*) as c FROM transactions
-            WHERE service_type = ? AND timestamp > ?
-        """, (service_type, (datetime.utcnow() - timedelta(hours=24)).isoformat()))
-        recent = cursor.fetchone()["c"] or 0
-        demand = min(2.0, max(0.5, recent / 5.0))
-        
-        trend = self._calc_trend(cursor, service_type)
+            WHERE service_type = ? AND timestamp > ? ORDER BY price LIMIT 1 OFFSET ?
+        """, (service_type, cutoff, count // 2))
+        row = cursor.fetchone()
+        median = row[0] if row else 0.01
         conn.close()
         
-        return MarketRate(service_type, median, stats["min_price"] or 0.01,
-                         stats["max_price"] or 0.01, stats["avg_price"] or 0.01,
-                         stats["count"], demand, trend, datetime.utcnow().isoformat())
-    
-    def _calc_trend(self, cursor, service_type: str) -> str:
-        now = datetime.utcnow()
-        w1 = (now - timedelta(days=7)).isoformat()
-        w2 = (now - timedelta(days=14)).isoformat()
+        demand = min(2.0, max(0.5, recent / 5.0))
         
-        cursor.execute("SELECT AVG(price) as a FROM transactions WHERE service_type=? AND timestamp>?", 
-                      (service_type, w1))
-        r1 = cursor.fetchone()
-        cursor.execute("SELECT AVG(price) as a FROM transactions WHERE service_type=? AND timestamp>? AND timestamp<=?",
-                      (service_type, w2, w1))
-        r2 = cursor.fetchone()
+        if not a1 or not a2:
+            trend = "unknown"
+        else:
+            chg = (a1 - a2) / a2 * 100
+            trend = "rising" if chg > 5 else "falling" if chg < -5 else "stable"
         
-        if not r1["a"] or not r2["a"]: return "unknown"
-        chg = (r1["a"] - r2["a"]) / r2["a"] * 100
-        if chg > 5: return "rising"
-        if chg < -5: return "falling"
-        return "stable"
+        return MarketRate(service_type, median, min_p or 0.01, max_p or 0.01, avg_p or 0.01,
+                         count, demand, trend, datetime.utcnow().isoformat())
     
     def get_all_services(self) -> List[Dict]:
         conn = self._get_db()
@@ -6,7 +6,9 @@ Handles multi-round bargaining between agents
 
 import json
 import os
+from bisect import bisect_right
 import sqlite3
+import threading
 import uuid
 from datetime import datetime, timedelta, UTC
 from typing import Dict, Optional, List
@@ -14,11 +16,59 @@ from dataclasses import dataclass, asdict
 from enum import Enum
 import logging
 
+from payment_service import get_payment_service
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("negotiation_engine")
 
 DB_PATH = os.path.expanduser("~/sentinel-economic/data/sentinel_economic.db")
 
+SCHEMA_SQL = """
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS negotiations (
+    id TEXT PRIMARY KEY,
+    service_id TEXT NOT NULL,
+    endpoint TEXT NOT NULL,
+    buyer_id TEXT NOT NULL,
+    quantity INTEGER DEFAULT 1,
+    initial_offer REAL NOT NULL,
+    current_offer REAL NOT NULL,
+    our_price REAL NOT NULL,
+    counter_price REAL,
+    status TEXT DEFAULT 'pending',
+    round_number INTEGER DEFAULT 1,
+    final_price REAL,
+    expires_at TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    metadata TEXT
+);
+
+CREATE TABLE IF NOT EXISTS negotiation_history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    negotiation_id TEXT NOT NULL,
+    round_number INTEGER NOT NULL,
+    actor TEXT NOT NULL,
+    action TEXT NOT NULL,
+    price REAL,
+    message TEXT,
+    created_at TEXT NOT NULL,
+    FOREIGN KEY (negotiation_id) REFERENCES negotiations(id)
+);
+
+COMMIT;
+"""
+
+# Schema is created once per process
+_schema_initialized = False
+_schema_lock = threading.Lock()
+
+# Bulk discount ladder: quantity tier boundaries and the unit price multiplier
+# for each band (below 20, 20+, 50+, 100+)
+_BULK_THRESHOLDS = (20, 50, 100)
+_BULK_FACTORS = (1.0, 0.9, 0.8, 0.7)
+
 
 class NegotiationStatus(Enum):
     PENDING = "pending"
@@ -62,58 +112,30 @@ class NegotiationEngine:
     MAX_ROUNDS = 3
     
     def __init__(self):
+        self._ps = get_payment_service()
+        self._get_endpoint_price = self._ps.get_endpoint_price
         self._ensure_db()
     
     def _ensure_db(self):
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS negotiations (
-                id TEXT PRIMARY KEY,
-                service_id TEXT NOT NULL,
-                endpoint TEXT NOT NULL,
-                buyer_id TEXT NOT NULL,
-                quantity INTEGER DEFAULT 1,
-                initial_offer REAL NOT NULL,
-                current_offer REAL NOT NULL,
-                our_price REAL NOT NULL,
-                counter_price REAL,
-                status TEXT DEFAULT 'pending',
-                round_number INTEGER DEFAULT 1,
-                final_price REAL,
-                expires_at TEXT NOT NULL,
-                created_at TEXT NOT NULL,
-                updated_at TEXT NOT NULL,
-                metadata TEXT
-            )
-        """)
-        
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS negotiation_history (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                negotiation_id TEXT NOT NULL,
-                round_number INTEGER NOT NULL,
-                actor TEXT NOT NULL,
-                action TEXT NOT NULL,
-                price REAL,
-                message TEXT,
-                created_at TEXT NOT NULL,
-                FOREIGN KEY (negotiation_id) REFERENCES negotiations(id)
-            )
-        """)
-        
-        conn.commit()
-        conn.close()
+        global _schema_initialized
+        if _schema_initialized:
+            return
+        with _schema_lock:
+            if _schema_initialized:
+                return
+            conn = sqlite3.connect(DB_PATH)
+            conn.executescript(SCHEMA_SQL)
+            conn.close()
+            _schema_initialized = True
     
-    def _get_db(self):
+    def _get_db(self, row_factory=sqlite3.Row):
         conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
+        conn.row_factory = row_factory
         return conn
     
     def _get_buyer_trust(self, buyer_id: str) -> float:
         """Get buyer trust score from transaction history"""
-        conn = self._get_db()
+        conn = self._get_db(row_factory=None)
         cursor = conn.cursor()
         
         cursor.execute("""
@@ -123,32 +145,24 @@ class NegotiationEngine:
             WHERE buyer_id = ?
         """, (buyer_id,))
         
-        stats = cursor.fetchone()
+        total_txns, total_spent = cursor.fetchone()
         conn.close()
         
-        if not stats or not stats["total_txns"]:
+        if not total_txns:
             return 0.5  # New buyer
         
         # Trust based on history
-        txn_score = min(stats["total_txns"] / 100, 1) * 0.5
-        spend_score = min((stats["total_spent"] or 0) / 50, 1) * 0.5
+        txn_score = min(total_txns / 100, 1) * 0.5
+        spend_score = min((total_spent or 0) / 50, 1) * 0.5
         
         return txn_score + spend_score
     
     def _get_our_price(self, service_id: str, endpoint: str, quantity: int = 1) -> float:
         """Get our optimal price for this request"""
-        from payment_service import get_payment_service
-        
-        ps = get_payment_service()
-        unit_price = ps.get_endpoint_price(service_id, endpoint, use_dynamic=True)
+        unit_price = self._get_endpoint_price(service_id, endpoint, use_dynamic=True)
         
         # Bulk discount
-        if quantity >= 100:
-            unit_price *= 0.7  # 30% discount
-        elif quantity >= 50:
-            unit_price *= 0.8  # 20% discount
-        elif quantity >= 20:
-            unit_price *= 0.9  # 10% discount
+        unit_price *= _BULK_FACTORS[bisect_right(_BULK_THRESHOLDS, quantity)]
         
         return round(unit_price * quantity, 4)
     
@@ -420,7 +434,7 @@ class NegotiationEngine:
     
     def get_negotiation(self, negotiation_id: str) -> Optional[Dict]:
         """Get negotiation details"""
-        conn = self._get_db()
+        conn = self._get_db(row_factory=None)
         cursor = conn.cursor()
         
         cursor.execute("SELECT * FROM negotiations WHERE id = ?", (negotiation_id,))
@@ -429,18 +443,20 @@ class NegotiationEngine:
         if not neg:
             conn.close()
             return None
+        neg_columns = [d[0] for d in cursor.description]
         
         cursor.execute("""
             SELECT * FROM negotiation_history 
             WHERE negotiation_id = ? 
             ORDER BY created_at ASC
         """, (negotiation_id,))
-        history = [dict(h) for h in cursor.fetchall()]
+        history_columns = [d[0] for d in cursor.description]
+        history = [dict(zip(history_columns, h)) for h in cursor.fetchall()]
         
         conn.close()
         
         return {
-            **dict(neg),
+            **dict(zip(neg_columns, neg)),
             "history": history
         }
 
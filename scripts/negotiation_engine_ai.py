@@ -4,13 +4,19 @@ Sentinel Economic — AI-Powered Negotiation Engine
 Replaces rule-based negotiation with AI agent
 """
 
+import atexit
 import json
 import os
+import queue
 import sqlite3
+import threading
+import time
 import uuid
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, UTC
 from typing import Dict, Optional
-from dataclasses import dataclass, asdict
+from dataclasses import dataclass
 from enum import Enum
 import logging
 
@@ -18,8 +24,10 @@ from ai_negotiation_agent import (
     get_ai_agent, 
     NegotiationContext, 
     BuyerProfile,
-    AIDecision
+    AIDecision,
+    HistoryRow
 )
+from market_intelligence import MarketIntelligence
 from payment_service import get_payment_service
 
 logging.basicConfig(level=logging.INFO)
@@ -27,6 +35,94 @@ logger = logging.getLogger("negotiation_engine_ai")
 
 DB_PATH = os.path.expanduser("~/sentinel-economic/data/sentinel_economic.db")
 
+SCHEMA_SQL = """
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS negotiations (
+    id TEXT PRIMARY KEY,
+    service_id TEXT NOT NULL,
+    endpoint TEXT NOT NULL,
+    buyer_id TEXT NOT NULL,
+    quantity INTEGER DEFAULT 1,
+    initial_offer REAL NOT NULL,
+    current_offer REAL NOT NULL,
+    our_price REAL NOT NULL,
+    counter_price REAL,
+    status TEXT DEFAULT 'pending',
+    round_number INTEGER DEFAULT 1,
+    final_price REAL,
+    ai_strategy TEXT,
+    ai_confidence REAL,
+    expires_at TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    metadata TEXT
+);
+
+CREATE TABLE IF NOT EXISTS negotiation_history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    negotiation_id TEXT NOT NULL,
+    round_number INTEGER NOT NULL,
+    actor TEXT NOT NULL,
+    action TEXT NOT NULL,
+    price REAL,
+    message TEXT,
+    ai_reasoning TEXT,
+    created_at TEXT NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_history_neg_created
+    ON negotiation_history(negotiation_id, created_at);
+CREATE INDEX IF NOT EXISTS idx_neg_buyer_created
+    ON negotiations(buyer_id, created_at);
+
+COMMIT;
+
+-- Refresh planner stats so the indexes above get picked; sampled to stay cheap
+PRAGMA analysis_limit = 1000;
+ANALYZE;
+"""
+
+# Schema is created once per process
+_schema_initialized = False
+_schema_lock = threading.Lock()
+
+INSERT_NEGOTIATION_SQL = """
+    INSERT INTO negotiations 
+    (id, service_id, endpoint, buyer_id, quantity, initial_offer, current_offer,
+     our_price, counter_price, status, round_number, final_price, ai_strategy,
+     ai_confidence, expires_at, created_at, updated_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+UPDATE_NEGOTIATION_SQL = """
+    UPDATE negotiations 
+    SET status = ?, round_number = ?, current_offer = ?, counter_price = ?,
+        final_price = ?, expires_at = ?, updated_at = ?
+    WHERE id = ?
+"""
+
+# RETURNING (SQLite 3.35+) hands back the stored row from the UPDATE itself
+HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+UPDATE_NEGOTIATION_RETURNING_SQL = UPDATE_NEGOTIATION_SQL.rstrip() + """
+    RETURNING status, round_number, current_offer, our_price, counter_price, expires_at
+"""
+
+INSERT_HISTORY_SQL = """
+    INSERT INTO negotiation_history 
+    (negotiation_id, round_number, actor, action, price, message, ai_reasoning, created_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+# Range of a SQLite INTEGER; anything outside it cannot be stored
+SQLITE_INT_MIN = -2**63
+SQLITE_INT_MAX = 2**63 - 1
+
+# Bulk discount ladder: quantity tier boundaries and the unit price multiplier
+# for each band (below 20, 20+, 50+, 100+)
+_BULK_THRESHOLDS = (20, 50, 100)
+_BULK_FACTORS = (1.0, 0.9, 0.8, 0.7)
+
 
 class NegotiationStatus(Enum):
     PENDING = "pending"
@@ -36,7 +132,7 @@ class NegotiationStatus(Enum):
     EXPIRED = "expired"
 
 
-@dataclass
+@dataclass(slots=True)
 class NegotiationResponse:
     negotiation_id: str
     status: str
@@ -51,107 +147,164 @@ class NegotiationResponse:
     ai_insights: Optional[Dict]  # NEW: AI reasoning
 
 
+class _ThreadConnection:
+    """Owns one thread's connection; optimizes and closes it when the thread exits"""
+    
+    __slots__ = ("conn",)
+    
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+    
+    def __del__(self):
+        try:
+            # Refresh planner stats gathered by this connection's queries
+            self.conn.execute("PRAGMA optimize")
+        except sqlite3.Error:
+            pass
+        self.conn.close()
+
+
 class AINegotiationEngine:
     """AI-powered negotiation engine"""
     
     MAX_ROUNDS = 3
+    FLUSH_TIMEOUT = 10  # seconds to wait for queued writes at shutdown
     
     def __init__(self):
         self.ai_agent = get_ai_agent()
         self.payment_service = get_payment_service()
+        self._local = threading.local()
+        # Loads market conditions while the request thread does its own lookups;
+        # one task per negotiation, sized for the threaded server's request load
+        self._executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix="negotiation")
         self._ensure_db()
+        # New negotiations are persisted off the request path; reads of a
+        # negotiation wait only for that negotiation's pending write
+        self._write_queue = queue.Queue(maxsize=1000)
+        self._pending_writes: Dict[str, threading.Event] = {}
+        self._pending_writes_lock = threading.Lock()
+        threading.Thread(target=self._writer_loop, name="negotiation-writer",
+                         daemon=True).start()
+        atexit.register(self.flush, self.FLUSH_TIMEOUT)
     
     def _ensure_db(self):
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS negotiations (
-                id TEXT PRIMARY KEY,
-                service_id TEXT NOT NULL,
-                endpoint TEXT NOT NULL,
-                buyer_id TEXT NOT NULL,
-                quantity INTEGER DEFAULT 1,
-                initial_offer REAL NOT NULL,
-                current_offer REAL NOT NULL,
-                our_price REAL NOT NULL,
-                counter_price REAL,
-                status TEXT DEFAULT 'pending',
-                round_number INTEGER DEFAULT 1,
-                final_price REAL,
-                ai_strategy TEXT,
-                ai_confidence REAL,
-                expires_at TEXT NOT NULL,
-                created_at TEXT NOT NULL,
-                updated_at TEXT NOT NULL,
-                metadata TEXT
-            )
-        """)
-        
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS negotiation_history (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                negotiation_id TEXT NOT NULL,
-                round_number INTEGER NOT NULL,
-                actor TEXT NOT NULL,
-                action TEXT NOT NULL,
-                price REAL,
-                message TEXT,
-                ai_reasoning TEXT,
-                created_at TEXT NOT NULL
-            )
-        """)
-        
-        conn.commit()
-        conn.close()
+        global _schema_initialized
+        if _schema_initialized:
+            return
+        with _schema_lock:
+            if _schema_initialized:
+                return
+            # Pooled context lookups read `transactions`; create it before any run
+            MarketIntelligence()
+            conn = sqlite3.connect(DB_PATH)
+            conn.execute("PRAGMA journal_mode=WAL")  # persistent, stored in the db file
+            conn.executescript(SCHEMA_SQL)
+            conn.close()
+            _schema_initialized = True
     
     def _get_db(self):
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        return conn
+        """Get this thread's persistent connection, opening it on first use"""
+        owner = getattr(self._local, "owner", None)
+        if owner is None:
+            conn = sqlite3.connect(DB_PATH, check_same_thread=False, cached_statements=256)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA temp_store=MEMORY")
+            conn.execute("PRAGMA wal_autocheckpoint=1000")
+            conn.execute("PRAGMA mmap_size=268435456")  # 256 MB
+            conn.execute("PRAGMA cache_size=-65536")  # 64 MB
+            conn.execute("PRAGMA analysis_limit=1000")  # keeps PRAGMA optimize cheap
+            conn.row_factory = sqlite3.Row
+            # Only the thread-local holds the owner, so the connection is
+            # closed as soon as its thread ends
+            owner = self._local.owner = _ThreadConnection(conn)
+        return owner.conn
+    
+    def _writer_loop(self):
+        """Apply queued write batches, one transaction per batch"""
+        conn = self._get_db()
+        while True:
+            negotiation_id, batch = self._write_queue.get()
+            try:
+                with conn:
+                    for sql, params in batch:
+                        if isinstance(params, list):
+                            conn.executemany(sql, params)
+                        else:
+                            conn.execute(sql, params)
+            except Exception as e:
+                # A bad batch must never take the writer thread down with it
+                logger.error(f"Failed to persist negotiation {negotiation_id}: {e}")
+            finally:
+                with self._pending_writes_lock:
+                    done = self._pending_writes.pop(negotiation_id, None)
+                if done is not None:
+                    done.set()
+    
+    def _queue_write(self, negotiation_id: str, batch: list):
+        """Hand a write batch to the writer thread"""
+        with self._pending_writes_lock:
+            self._pending_writes[negotiation_id] = threading.Event()
+        self._write_queue.put((negotiation_id, batch))
+    
+    def _wait_for_write(self, negotiation_id: str):
+        """Block until this negotiation's queued write (if any) is committed"""
+        done = self._pending_writes.get(negotiation_id)
+        if done is not None:
+            done.wait()
+    
+    def flush(self, timeout: float = None):
+        """Wait for every write queued so far, up to timeout seconds"""
+        with self._pending_writes_lock:
+            pending = list(self._pending_writes.values())
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for done in pending:
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            if not done.wait(remaining):
+                logger.warning(f"Gave up waiting for {len(pending)} queued negotiation writes")
+                return
     
     def _get_our_price(self, service_id: str, endpoint: str, quantity: int = 1) -> float:
         """Get optimal price using payment service"""
         unit_price = self.payment_service.get_endpoint_price(service_id, endpoint, use_dynamic=True)
         
         # Bulk discount
-        if quantity >= 100:
-            unit_price *= 0.7
-        elif quantity >= 50:
-            unit_price *= 0.8
-        elif quantity >= 20:
-            unit_price *= 0.9
+        unit_price *= _BULK_FACTORS[bisect_right(_BULK_THRESHOLDS, quantity)]
         
         return round(unit_price * quantity, 4)
     
     def _get_negotiation_history(self, negotiation_id: str) -> list:
-        """Get negotiation history"""
+        """Get negotiation history as HistoryRow tuples"""
         conn = self._get_db()
         cursor = conn.cursor()
+        cursor.row_factory = lambda _cursor, row: HistoryRow(*row)
         
         cursor.execute("""
-            SELECT * FROM negotiation_history 
+            SELECT id, negotiation_id, round_number, actor, action, price, message,
+                   ai_reasoning, created_at
+            FROM negotiation_history 
             WHERE negotiation_id = ? 
             ORDER BY created_at ASC
         """, (negotiation_id,))
         
-        history = [dict(row) for row in cursor.fetchall()]
-        conn.close()
-        return history
+        return cursor.fetchall()
     
     def start_negotiation(self, service_id: str, endpoint: str, buyer_id: str,
                           offered_price: float, quantity: int = 1) -> NegotiationResponse:
         """Start AI-powered negotiation"""
         
+        if not SQLITE_INT_MIN <= quantity <= SQLITE_INT_MAX:
+            raise ValueError("quantity is out of range")
+        
         negotiation_id = f"neg_{uuid.uuid4().hex[:12]}"
+        
+        # Market conditions load while this thread prices the request and reads the profile
+        market_future = self._executor.submit(self.ai_agent.get_market_conditions)
+        
         our_price = self._get_our_price(service_id, endpoint, quantity)
         min_acceptable = our_price * 0.6
-        
-        # Get buyer profile
         buyer_profile = self.ai_agent.get_buyer_profile(buyer_id)
-        
-        # Get market conditions
-        market_conditions = self.ai_agent.get_market_conditions()
+        market_conditions = market_future.result()
         
         # Build context for AI
         context = NegotiationContext(
@@ -174,6 +327,7 @@ class AINegotiationEngine:
         
         # Map AI decision to negotiation status
         now = datetime.now(UTC)
+        now_iso = now.isoformat()
         expires_at = (now + timedelta(minutes=30)).isoformat()
         
         if decision.action == "accept":
@@ -186,41 +340,23 @@ class AINegotiationEngine:
             status = NegotiationStatus.REJECTED.value
             final_price = None
         
-        # Save to database
-        conn = self._get_db()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            INSERT INTO negotiations 
-            (id, service_id, endpoint, buyer_id, quantity, initial_offer, current_offer,
-             our_price, counter_price, status, round_number, final_price, ai_strategy,
-             ai_confidence, expires_at, created_at, updated_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
-            negotiation_id, service_id, endpoint, buyer_id, quantity,
-            offered_price, offered_price, our_price, decision.counter_price,
-            status, 1, final_price, decision.strategy, decision.confidence,
-            expires_at, now.isoformat(), now.isoformat()
-        ))
-        
-        # Log history
-        cursor.execute("""
-            INSERT INTO negotiation_history 
-            (negotiation_id, round_number, actor, action, price, message, ai_reasoning, created_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        """, (negotiation_id, 1, "buyer", "offer", offered_price, 
-              f"Initial offer: ${offered_price}", None, now.isoformat()))
-        
-        cursor.execute("""
-            INSERT INTO negotiation_history 
-            (negotiation_id, round_number, actor, action, price, message, ai_reasoning, created_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        """, (negotiation_id, 1, "seller", decision.action, 
-              decision.counter_price or final_price, decision.suggested_message,
-              decision.reasoning, now.isoformat()))
-        
-        conn.commit()
-        conn.close()
+        # Save to database (committed by the writer thread)
+        self._queue_write(negotiation_id, [
+            (INSERT_NEGOTIATION_SQL, (
+                negotiation_id, service_id, endpoint, buyer_id, quantity,
+                offered_price, offered_price, our_price, decision.counter_price,
+                status, 1, final_price, decision.strategy, decision.confidence,
+                expires_at, now_iso, now_iso
+            )),
+            # Log history
+            (INSERT_HISTORY_SQL, [
+                (negotiation_id, 1, "buyer", "offer", offered_price,
+                 f"Initial offer: ${offered_price}", None, now_iso),
+                (negotiation_id, 1, "seller", decision.action,
+                 decision.counter_price or final_price, decision.suggested_message,
+                 decision.reasoning, now_iso)
+            ])
+        ])
         
         return NegotiationResponse(
             negotiation_id=negotiation_id,
@@ -245,33 +381,41 @@ class AINegotiationEngine:
                            new_offer: float = None) -> NegotiationResponse:
         """Handle buyer's response with AI decision"""
         
+        self._wait_for_write(negotiation_id)
         conn = self._get_db()
         cursor = conn.cursor()
+        cursor.row_factory = None  # plain tuples, unpacked below
         
-        cursor.execute("SELECT * FROM negotiations WHERE id = ?", (negotiation_id,))
+        cursor.execute("""
+            SELECT status, round_number, counter_price, our_price, service_id,
+                   endpoint, buyer_id, quantity, current_offer
+            FROM negotiations WHERE id = ?
+        """, (negotiation_id,))
         neg = cursor.fetchone()
         
         if not neg:
-            conn.close()
             raise ValueError("Negotiation not found")
         
-        if neg["status"] in [NegotiationStatus.ACCEPTED.value,
-                             NegotiationStatus.REJECTED.value,
-                             NegotiationStatus.EXPIRED.value]:
-            conn.close()
-            raise ValueError(f"Negotiation already {neg['status']}")
+        (neg_status, round_number, neg_counter_price, our_price, service_id,
+         endpoint, buyer_id, quantity, current_offer) = neg
         
-        if neg["round_number"] >= self.MAX_ROUNDS:
-            conn.close()
+        if neg_status in [NegotiationStatus.ACCEPTED.value,
+                          NegotiationStatus.REJECTED.value,
+                          NegotiationStatus.EXPIRED.value]:
+            raise ValueError(f"Negotiation already {neg_status}")
+        
+        if round_number >= self.MAX_ROUNDS:
             raise ValueError("Maximum negotiation rounds reached")
         
         now = datetime.now(UTC)
-        new_round = neg["round_number"] + 1
+        now_iso = now.isoformat()
+        expires_at = (now + timedelta(minutes=30)).isoformat()
+        new_round = round_number + 1
         
         if action == "accept":
             # Buyer accepts our counter
             status = NegotiationStatus.ACCEPTED.value
-            final_price = neg["counter_price"]
+            final_price = neg_counter_price
             counter_price = None
             message = "Deal accepted! Proceed to payment."
             ai_insights = {"strategy": "buyer_accepted", "confidence": 1.0}
@@ -281,20 +425,21 @@ class AINegotiationEngine:
             
         elif action == "counter" and new_offer is not None:
             # Buyer counters - AI decides again
-            buyer_profile = self.ai_agent.get_buyer_profile(neg["buyer_id"])
-            market_conditions = self.ai_agent.get_market_conditions()
+            market_future = self._executor.submit(self.ai_agent.get_market_conditions)
             history = self._get_negotiation_history(negotiation_id)
+            buyer_profile = self.ai_agent.get_buyer_profile(buyer_id)
+            market_conditions = market_future.result()
             
             context = NegotiationContext(
                 negotiation_id=negotiation_id,
-                service_id=neg["service_id"],
-                endpoint=neg["endpoint"],
-                buyer_id=neg["buyer_id"],
+                service_id=service_id,
+                endpoint=endpoint,
+                buyer_id=buyer_id,
                 buyer_profile=buyer_profile,
-                our_price=neg["our_price"],
-                min_acceptable=neg["our_price"] * 0.6,
+                our_price=our_price,
+                min_acceptable=our_price * 0.6,
                 offered_price=new_offer,
-                quantity=neg["quantity"],
+                quantity=quantity,
                 round_number=new_round,
                 history=history,
                 market_conditions=market_conditions
@@ -335,43 +480,35 @@ class AINegotiationEngine:
             self.ai_agent.record_outcome(negotiation_id, "rejected", None)
             
         else:
-            conn.close()
             raise ValueError("Invalid action. Use: accept, counter, reject")
         
         # Update database
-        expires_at = (now + timedelta(minutes=30)).isoformat()
-        
-        cursor.execute("""
-            UPDATE negotiations 
-            SET status = ?, round_number = ?, current_offer = ?, counter_price = ?,
-                final_price = ?, expires_at = ?, updated_at = ?
-            WHERE id = ?
-        """, (status, new_round, new_offer or neg["current_offer"], counter_price,
-              final_price, expires_at, now.isoformat(), negotiation_id))
-        
-        # Log history
-        cursor.execute("""
-            INSERT INTO negotiation_history 
-            (negotiation_id, round_number, actor, action, price, message, created_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, (negotiation_id, new_round, "buyer", action, new_offer, 
-              f"Buyer {action}", now.isoformat()))
-        
-        cursor.execute("""
-            INSERT INTO negotiation_history 
-            (negotiation_id, round_number, actor, action, price, message, ai_reasoning, created_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        """, (negotiation_id, new_round, "seller", status, counter_price or final_price,
-              message, ai_insights.get("reasoning"), now.isoformat()))
-        
-        conn.commit()
-        conn.close()
+        update_params = (status, new_round, new_offer or current_offer, counter_price,
+                         final_price, expires_at, now_iso, negotiation_id)
+        with conn:
+            if HAS_RETURNING:
+                stored = conn.execute(UPDATE_NEGOTIATION_RETURNING_SQL, update_params).fetchone()
+                if stored is None:
+                    raise ValueError("Negotiation not found")
+                (status, new_round, current_offer, our_price,
+                 counter_price, expires_at) = tuple(stored)
+            else:
+                conn.execute(UPDATE_NEGOTIATION_SQL, update_params)
+                current_offer = new_offer or current_offer
+            
+            # Log history
+            conn.executemany(INSERT_HISTORY_SQL, [
+                (negotiation_id, new_round, "buyer", action, new_offer,
+                 f"Buyer {action}", None, now_iso),
+                (negotiation_id, new_round, "seller", status, counter_price or final_price,
+                 message, ai_insights.get("reasoning"), now_iso)
+            ])
         
         return NegotiationResponse(
             negotiation_id=negotiation_id,
             status=status,
-            your_offer=new_offer or neg["current_offer"],
-            our_price=neg["our_price"],
+            your_offer=current_offer,
+            our_price=our_price,
             counter_price=counter_price,
             message=message,
             round_number=new_round,
@@ -383,6 +520,7 @@ class AINegotiationEngine:
     
     def get_negotiation(self, negotiation_id: str) -> Optional[Dict]:
         """Get negotiation with AI insights"""
+        self._wait_for_write(negotiation_id)
         conn = self._get_db()
         cursor = conn.cursor()
         
@@ -390,25 +528,26 @@ class AINegotiationEngine:
         neg = cursor.fetchone()
         
         if not neg:
-            conn.close()
             return None
         
         history = self._get_negotiation_history(negotiation_id)
-        conn.close()
         
         return {
             **dict(neg),
-            "history": history
+            "history": [row._asdict() for row in history]
         }
 
 
 # Singleton
 _ai_engine = None
+_ai_engine_lock = threading.Lock()
 
 def get_ai_negotiation_engine() -> AINegotiationEngine:
     global _ai_engine
     if _ai_engine is None:
-        _ai_engine = AINegotiationEngine()
+        with _ai_engine_lock:
+            if _ai_engine is None:
+                _ai_engine = AINegotiationEngine()
     return _ai_engine
 
 
@@ -4,13 +4,16 @@ Sentinel Economic — Unified Payment Service
 Handles x402 (PayAI) payments for all services
 """
 
+import functools
+import hashlib
 import json
 import os
-import yaml
-import requests
+import threading
+import time
+from concurrent.futures import Future
 from datetime import datetime, timedelta
 from typing import Dict, Optional, Tuple
-from dataclasses import dataclass
+from dataclasses import dataclass, is_dataclass
 import logging
 
 logging.basicConfig(level=logging.INFO)
@@ -18,8 +21,29 @@ logger = logging.getLogger("payment_service")
 
 CONFIG_DIR = os.path.join(os.path.dirname(__file__), '..', 'config')
 
+PRICE_CACHE_TTL = 30  # seconds an endpoint price is reused
 
-@dataclass
+USDC_MICRO = 1_000_000  # USDC has 6 decimals
+
+
+def to_micro(amount: float) -> int:
+    """Convert a USDC amount to integer micro-USDC"""
+    return int(round(amount * USDC_MICRO))
+
+
+def _dataclass_fields(obj) -> Dict:
+    """Shallow field mapping for json.dumps; nested values are already plain"""
+    if not is_dataclass(obj) or isinstance(obj, type):
+        raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+    return {name: getattr(obj, name) for name in obj.__dataclass_fields__}
+
+
+def to_json_bytes(obj) -> bytes:
+    """Serialize a response dataclass to compact JSON without an asdict() deep copy"""
+    return json.dumps(obj, default=_dataclass_fields, separators=(",", ":")).encode()
+
+
+@dataclass(slots=True)
 class PaymentRequirement:
     service_id: str
     endpoint: str
@@ -30,7 +54,7 @@ class PaymentRequirement:
     metadata: Dict
 
 
-@dataclass 
+@dataclass(slots=True)
 class PaymentResult:
     success: bool
     method: str  # "x402", "token_gating"
@@ -42,33 +66,95 @@ class PaymentResult:
 
 class PaymentService:
     def __init__(self):
-        self.services = self._load_services()
-        self.global_config = self._load_global_config()
+        config = self._load_config()
+        self.services = config.get('services', {})
+        self.global_config = config.get('global', {})
+        self._prefix_indexes = self._build_prefix_indexes(self.services)
+        self._pricing_engines: Dict[str, object] = {}
+        self._pricing_lock = threading.Lock()
+        # HTTP session is created on first facilitator call
+        self._session = None
+        self._session_lock = threading.Lock()
+        # Facilitator calls in flight, keyed by payment digest
+        self._inflight: Dict[bytes, Future] = {}
+        self._inflight_lock = threading.Lock()
+        
+    def _load_config(self) -> Dict:
+        """Load service registry and global payment config from YAML"""
+        import yaml  # only needed once, at startup
         
-    def _load_services(self) -> Dict:
-        """Load service registry from YAML"""
         path = os.path.join(CONFIG_DIR, 'services.yaml')
+        loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)  # libyaml when available
         with open(path, 'r') as f:
-            config = yaml.safe_load(f)
-        return config.get('services', {})
+            return yaml.load(f, Loader=loader)
     
-    def _load_global_config(self) -> Dict:
-        """Load global payment config"""
-        path = os.path.join(CONFIG_DIR, 'services.yaml')
-        with open(path, 'r') as f:
-            config = yaml.safe_load(f)
-        return config.get('global', {})
+    @staticmethod
+    def _build_prefix_indexes(services: Dict) -> Dict[str, list]:
+        """Route prefixes per service, longest first, for parameterized endpoints"""
+        return {
+            service_id: sorted(
+                ((ep.split('<')[0].rstrip('/'), config.get('price', 0.01))
+                 for ep, config in service.get('endpoints', {}).items()),
+                key=lambda item: -len(item[0])
+            )
+            for service_id, service in services.items()
+        }
+    
+    @property
+    def _http(self):
+        """Pooled keep-alive session for facilitator calls, created lazily"""
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    self._session = self._create_session()
+        return self._session
+    
+    def _create_session(self):
+        """Build the requests session; requests is imported on first use"""
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+        
+        session = requests.Session()
+        # POST is not retried on read errors, only on failed connects
+        retry = Retry(total=2, backoff_factor=0.1)
+        session.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=64,
+                                              max_retries=retry))
+        return session
     
     def get_service(self, service_id: str) -> Optional[Dict]:
         """Get service configuration"""
         return self.services.get(service_id)
     
+    def _get_pricing_engine(self, service_id: str):
+        """Get the DynamicPricingAI (and its MarketIntelligence) for a service"""
+        engine = self._pricing_engines.get(service_id)
+        if engine is None:
+            with self._pricing_lock:
+                engine = self._pricing_engines.get(service_id)
+                if engine is None:
+                    # Import here to avoid circular dependency
+                    from dynamic_pricing import DynamicPricingAI
+                    from market_intelligence import MarketIntelligence
+                    
+                    engine = DynamicPricingAI(service_id, MarketIntelligence(service_id))
+                    self._pricing_engines[service_id] = engine
+        return engine
+    
     def get_endpoint_price(self, service_id: str, endpoint: str, 
                            use_dynamic: bool = True) -> float:
         """
         Get price for an endpoint.
         If use_dynamic=True, applies dynamic pricing factors.
+        Prices are cached for up to PRICE_CACHE_TTL seconds.
         """
+        return self._cached_price(service_id, endpoint, use_dynamic,
+                                  int(time.time() // PRICE_CACHE_TTL))
+    
+    @functools.lru_cache(maxsize=1024)
+    def _cached_price(self, service_id: str, endpoint: str, use_dynamic: bool,
+                      time_bucket: int) -> float:
+        """Compute an endpoint price; time_bucket only partitions the cache"""
         service = self.get_service(service_id)
         if not service:
             return 0.01  # Default
@@ -81,18 +167,13 @@ class PaymentService:
         else:
             # Partial match (for parameterized routes like /api/v1/signal/<slug>)
             base_price = 0.01
-            for ep, config in endpoints.items():
-                if endpoint.startswith(ep.split('<')[0].rstrip('/')):
-                    base_price = config.get('price', 0.01)
+            for prefix, price in self._prefix_indexes.get(service_id, ()):
+                if endpoint.startswith(prefix):
+                    base_price = price
                     break
         
         if use_dynamic:
-            # Import here to avoid circular dependency
-            from dynamic_pricing import DynamicPricingAI
-            from market_intelligence import MarketIntelligence
-            
-            mi = MarketIntelligence(service_id)
-            pricing = DynamicPricingAI(service_id, mi)
+            pricing = self._get_pricing_engine(service_id)
             
             # Map endpoint to service_type
             service_type = self._endpoint_to_service_type(service_id, endpoint)
@@ -104,6 +185,7 @@ class PaymentService:
         
         return base_price
     
+    @functools.lru_cache(maxsize=1024)
     def _endpoint_to_service_type(self, service_id: str, endpoint: str) -> str:
         """Map endpoint to service_type for market intelligence"""
         # Simple mapping - can be enhanced
@@ -127,7 +209,7 @@ class PaymentService:
             raise ValueError(f"Unknown service: {service_id}")
         
         price = self.get_endpoint_price(service_id, endpoint)
-        price_micro = int(price * 1_000_000)  # Convert to micro-USDC
+        price_micro = to_micro(price)
         
         # Build payment methods
         payment_methods = []
@@ -172,17 +254,54 @@ class PaymentService:
     
     def verify_x402_payment(self, service_id: str, endpoint: str,
                             payment_header: str) -> PaymentResult:
-        """Verify and settle x402 payment"""
+        """
+        Verify and settle x402 payment.
+        Concurrent submissions of the same payment share one facilitator
+        round-trip; only the first caller is granted the settled payment.
+        """
+        key = hashlib.sha256(
+            f"{service_id}|{endpoint}|{payment_header}".encode()
+        ).digest()
+        
+        with self._inflight_lock:
+            pending = self._inflight.get(key)
+            if pending is None:
+                pending = self._inflight[key] = Future()
+                owner = True
+            else:
+                owner = False
+        
+        if not owner:
+            result = pending.result()
+            if result.success:
+                return PaymentResult(False, "x402", 0, None, result.buyer_id,
+                                     "Duplicate payment submission")
+            return result
+        
+        try:
+            result = self._verify_and_settle(service_id, endpoint, payment_header)
+            pending.set_result(result)
+            return result
+        except BaseException as e:
+            pending.set_exception(e)
+            raise
+        finally:
+            with self._inflight_lock:
+                del self._inflight[key]
+    
+    def _verify_and_settle(self, service_id: str, endpoint: str,
+                           payment_header: str) -> PaymentResult:
+        """Run the facilitator /verify and /settle calls"""
         service = self.get_service(service_id)
         if not service:
             return PaymentResult(False, "x402", 0, None, None, "Unknown service")
         
         price = self.get_endpoint_price(service_id, endpoint)
-        price_micro = int(price * 1_000_000)
+        price_micro = to_micro(price)
         
         try:
             # Verify with facilitator
-            verify_response = requests.post(
+            verify_response = self._http.post(
                 f"{self.global_config['facilitator_url']}/verify",
                 json={
                     "x402Version": 2,
@@ -201,19 +320,28 @@ class PaymentService:
             if verify_response.status_code == 200:
                 result = verify_response.json()
                 if result.get("valid") or result.get("isValid"):
+                    tx_hash = result.get("txHash") or result.get("signature")
+                    buyer = result.get("payer") or result.get("from")
+                    
                     # Settle payment
-                    settle_response = requests.post(
+                    settle_response = self._http.post(
                         f"{self.global_config['facilitator_url']}/settle",
                         json={"x402Version": 2, "payment": payment_header},
                         timeout=30
                     )
                     
-                    tx_hash = result.get("txHash") or result.get("signature")
-                    buyer = result.get("payer") or result.get("from")
+                    # Only a confirmed settlement is recorded and grants access
+                    if settle_response.status_code != 200:
+                        return PaymentResult(False, "x402", 0, None, None,
+                                           f"Settle error: {settle_response.status_code}")
+                    settle_result = settle_response.json()
+                    if settle_result.get("success") is False:
+                        return PaymentResult(False, "x402", 0, None, None,
+                                           settle_result.get("errorReason")
+                                           or settle_result.get("error", "Settlement failed"))
                     
-                    # Record transaction
-                    self._record_transaction(service_id, endpoint, price, 
-                                            "x402", tx_hash, buyer)
+                    self._record_transaction(service_id, endpoint, price,
+                                             "x402", tx_hash, buyer)
                     
                     return PaymentResult(True, "x402", price, tx_hash, buyer, "settled")
                 
@@ -262,9 +390,7 @@ class PaymentService:
                            method: str, tx_hash: str, buyer_id: str):
         """Record transaction to market intelligence"""
         try:
-            from market_intelligence import MarketIntelligence
-            
-            mi = MarketIntelligence(service_id)
+            mi = self._get_pricing_engine(service_id).market_intel
             service_type = self._endpoint_to_service_type(service_id, endpoint)
             
             mi.record_transaction(
@@ -275,7 +401,8 @@ class PaymentService:
                 currency="USDC",
                 tx_hash=tx_hash,
                 source=method,
-                metadata={"endpoint": endpoint}
+                metadata={"endpoint": endpoint},
+                synchronous=False
             )
             
             logger.info(f"Recorded transaction: {service_id} | {endpoint} | ${price} | {method}")
@@ -286,11 +413,14 @@ class PaymentService:
 
 # Singleton instance
 _payment_service = None
+_payment_service_lock = threading.Lock()
 
 def get_payment_service() -> PaymentService:
     global _payment_service
     if _payment_service is None:
-        _payment_service = PaymentService()
+        with _payment_service_lock:
+            if _payment_service is None:
+                _payment_service = PaymentService()
     return _payment_service
 
 
@@ -4,13 +4,75 @@ Sentinel Economic Client SDK
 Use this to integrate any service with Sentinel Economic
 """
 
+import asyncio
+import json
+import logging
+import threading
+import time
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from functools import wraps
-from flask import request, jsonify, Response
-from typing import Optional, Dict
+from flask import request, Response
+from typing import Optional, Dict, Tuple
 from dataclasses import dataclass
 
 
+CACHE_TTL = 30  # seconds a successful lookup is reused
+NEGATIVE_CACHE_TTL = 5  # shorter reuse for failures so a recovering backend is retried soon
+CACHE_MAX_SIZE = 4096
+
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+LOG_RATE_LIMIT = 5  # seconds between repeats of the same log message
+
+
+class _RateLimitFilter(logging.Filter):
+    """Pass each distinct message at most once per interval, so an outage can't flood the log"""
+    
+    def __init__(self, interval: float = LOG_RATE_LIMIT):
+        super().__init__()
+        self.interval = interval
+        self._last_emitted = {}
+    
+    def filter(self, record: logging.LogRecord) -> bool:
+        # Keyed on the unformatted message, so "Price fetch error: %s" is one key
+        key = (record.levelno, record.msg)
+        now = time.monotonic()
+        if now - self._last_emitted.get(key, float("-inf")) < self.interval:
+            return False
+        self._last_emitted[key] = now
+        return True
+
+
+# Library logger: the host application decides handlers and levels
+logger = logging.getLogger("sentinel_economic_client")
+logger.addHandler(logging.NullHandler())
+logger.addFilter(_RateLimitFilter())
+
+
+class _TTLCache:
+    """Thread-safe dict of key -> (value, expiry), evicting oldest entries when full"""
+    
+    def __init__(self, maxsize: int = CACHE_MAX_SIZE):
+        self.maxsize = maxsize
+        self._data = {}
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is not None and entry[1] > time.monotonic():
+            return entry[0]
+        return None
+    
+    def set(self, key, value, ttl: float):
+        with self._lock:
+            self._data.pop(key, None)
+            if len(self._data) >= self.maxsize:
+                del self._data[next(iter(self._data))]
+            self._data[key] = (value, time.monotonic() + ttl)
+
+
 @dataclass
 class SentinelEconomicConfig:
     base_url: str = "http://localhost:8100"
@@ -24,116 +86,363 @@ class SentinelEconomicClient:
     def __init__(self, config: SentinelEconomicConfig = None):
         self.config = config or SentinelEconomicConfig()
         self.base_url = self.config.base_url.rstrip('/')
+        self._session = self._create_session()
+        self._price_cache = _TTLCache()
+        self._req_cache = _TTLCache()
+        self._token_cache = _TTLCache()
+        self._auth_cache = _TTLCache()
+        self._gateway_supported = True  # cleared if the backend predates /api/gateway/authorize
+    
+    def _create_session(self) -> requests.Session:
+        """Keep-alive session shared by all calls from this client"""
+        session = requests.Session()
+        # Retries cover failed connects; POSTs are never re-sent after a response
+        adapter = HTTPAdapter(
+            pool_connections=10, pool_maxsize=50,
+            max_retries=Retry(total=2, backoff_factor=0.1)
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        # Responses are a few hundred bytes; decode them straight from bytes
+        # and skip gzip, which costs more than it saves at that size
+        session.headers.update({"User-Agent": "sentinel-economic-sdk", "Accept-Encoding": "identity"})
+        return session
+    
+    def _post(self, path: str, payload: Dict) -> requests.Response:
+        """POST a pre-serialized compact JSON body to the economic API"""
+        return self._session.post(
+            f"{self.base_url}{path}",
+            data=json.dumps(payload, separators=(",", ":")),
+            headers=JSON_HEADERS,
+            timeout=self.config.timeout
+        )
+    
+    def close(self):
+        """Close pooled connections"""
+        self._session.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
     
     def get_price(self, endpoint: str, use_dynamic: bool = True) -> float:
         """Get price for an endpoint"""
+        key = (self.config.service_id, endpoint, use_dynamic)
+        cached = self._price_cache.get(key)
+        if cached is not None:
+            return cached
         try:
-            resp = requests.post(
-                f"{self.base_url}/api/pricing/calculate",
-                json={
-                    "service_id": self.config.service_id,
-                    "endpoint": endpoint,
-                    "use_dynamic": use_dynamic
-                },
-                timeout=self.config.timeout
-            )
+            resp = self._post("/api/pricing/calculate", {
+                "service_id": self.config.service_id,
+                "endpoint": endpoint,
+                "use_dynamic": use_dynamic
+            })
             if resp.status_code == 200:
-                return resp.json().get("price", 0.01)
+                price = json.loads(resp.content).get("price", 0.01)
+                self._price_cache.set(key, price, CACHE_TTL)
+                return price
         except Exception as e:
-            print(f"[SentinelEconomic] Price fetch error: {e}")
+            logger.warning("Price fetch error: %s", e)
+        self._price_cache.set(key, 0.01, NEGATIVE_CACHE_TTL)
         return 0.01  # Default fallback
     
     def get_payment_requirements(self, endpoint: str, method: str = "GET") -> Dict:
         """Get 402 payment requirements"""
+        key = (self.config.service_id, endpoint, method)
+        cached = self._req_cache.get(key)
+        if cached is not None:
+            return cached
         try:
-            resp = requests.post(
-                f"{self.base_url}/api/payment/requirements",
-                json={
-                    "service_id": self.config.service_id,
-                    "endpoint": endpoint,
-                    "method": method
-                },
-                timeout=self.config.timeout
-            )
+            resp = self._post("/api/payment/requirements", {
+                "service_id": self.config.service_id,
+                "endpoint": endpoint,
+                "method": method
+            })
             if resp.status_code == 200:
-                return resp.json()
+                requirements = json.loads(resp.content)
+                self._req_cache.set(key, requirements, CACHE_TTL)
+                return requirements
         except Exception as e:
-            print(f"[SentinelEconomic] Payment requirements error: {e}")
+            logger.warning("Payment requirements error: %s", e)
+        self._req_cache.set(key, {}, NEGATIVE_CACHE_TTL)
         return {}
     
     def verify_payment(self, endpoint: str, payment_header: str) -> Dict:
         """Verify x402 payment"""
         try:
-            resp = requests.post(
-                f"{self.base_url}/api/payment/verify",
-                json={
-                    "service_id": self.config.service_id,
-                    "endpoint": endpoint,
-                    "payment": payment_header
-                },
-                timeout=self.config.timeout
-            )
-            return resp.json()
+            resp = self._post("/api/payment/verify", {
+                "service_id": self.config.service_id,
+                "endpoint": endpoint,
+                "payment": payment_header
+            })
+            return json.loads(resp.content)
         except Exception as e:
-            print(f"[SentinelEconomic] Payment verify error: {e}")
-        return {"success": False, "message": str(e)}
+            logger.warning("Payment verify error: %s", e)
+            return {"success": False, "message": str(e)}
     
     def verify_token_holder(self, wallet_address: str) -> Dict:
         """Verify token holder for free access"""
+        cached = self._token_cache.get(wallet_address)
+        if cached is not None:
+            return cached
         try:
-            resp = requests.post(
-                f"{self.base_url}/api/payment/verify-token",
-                json={
-                    "service_id": self.config.service_id,
-                    "wallet_address": wallet_address
-                },
-                timeout=self.config.timeout
-            )
-            return resp.json()
+            resp = self._post("/api/payment/verify-token", {
+                "service_id": self.config.service_id,
+                "wallet_address": wallet_address
+            })
+            result = json.loads(resp.content)
         except Exception as e:
-            print(f"[SentinelEconomic] Token verify error: {e}")
-        return {"success": False, "message": str(e)}
+            logger.warning("Token verify error: %s", e)
+            result = {"success": False, "message": str(e)}
+        self._token_cache.set(wallet_address, result,
+                              CACHE_TTL if result.get("success") else NEGATIVE_CACHE_TTL)
+        return result
+    
+    def authorize(self, endpoint: str, method: str = "GET", wallet_address: str = None,
+                  payment_header: str = None) -> Dict:
+        """
+        Token-holder check, x402 verification and 402 requirements in one round-trip.
+        Returns {"token_holder", "payment_result", "requirements"}; falls back to
+        the separate calls when the backend has no gateway endpoint.
+        """
+        # Results without a payment are safe to reuse briefly
+        key = None if payment_header else (endpoint, method, wallet_address)
+        if key is not None:
+            cached = self._auth_cache.get(key)
+            if cached is not None:
+                return cached
+        
+        result = None
+        if self._gateway_supported:
+            try:
+                resp = self._post("/api/gateway/authorize", {
+                    "service_id": self.config.service_id,
+                    "endpoint": endpoint,
+                    "method": method,
+                    "wallet_address": wallet_address,
+                    "payment": payment_header
+                })
+                if resp.status_code == 200:
+                    result = json.loads(resp.content)
+                elif resp.status_code == 404:
+                    self._gateway_supported = False
+            except Exception as e:
+                logger.warning("Authorize error: %s", e)
+        
+        if result is None:
+            return self._authorize_separately(endpoint, method, wallet_address, payment_header)
+        
+        if key is not None:
+            granted = (result.get("token_holder") or {}).get("success")
+            ttl = CACHE_TTL if granted or result.get("requirements") else NEGATIVE_CACHE_TTL
+            self._auth_cache.set(key, result, ttl)
+        return result
+    
+    def _authorize_separately(self, endpoint: str, method: str, wallet_address: Optional[str],
+                              payment_header: Optional[str]) -> Dict:
+        """Same result as authorize(), built from the individual endpoints"""
+        result = {"token_holder": None, "payment_result": None, "requirements": None}
+        if wallet_address:
+            result["token_holder"] = self.verify_token_holder(wallet_address)
+            if result["token_holder"].get("success"):
+                return result
+        if payment_header:
+            result["payment_result"] = self.verify_payment(endpoint, payment_header)
+            return result
+        result["requirements"] = self.get_payment_requirements(endpoint, method)
+        return result
     
     def record_transaction(self, service_type: str, buyer_id: str, 
                           price: float, tx_hash: str = None) -> bool:
         """Manually record a transaction"""
         try:
-            resp = requests.post(
-                f"{self.base_url}/api/market/transaction",
-                json={
-                    "service_type": service_type,
-                    "seller_id": self.config.service_id,
-                    "buyer_id": buyer_id,
-                    "price": price,
-                    "tx_hash": tx_hash,
-                    "source": "sdk"
-                },
-                timeout=self.config.timeout
-            )
+            resp = self._post("/api/market/transaction", {
+                "service_type": service_type,
+                "seller_id": self.config.service_id,
+                "buyer_id": buyer_id,
+                "price": price,
+                "tx_hash": tx_hash,
+                "source": "sdk"
+            })
             return resp.status_code == 200
         except Exception as e:
-            print(f"[SentinelEconomic] Record transaction error: {e}")
+            logger.warning("Record transaction error: %s", e)
         return False
     
     def start_negotiation(self, endpoint: str, buyer_id: str, 
                          offered_price: float, quantity: int = 1) -> Dict:
         """Start price negotiation"""
         try:
-            resp = requests.post(
-                f"{self.base_url}/api/negotiate/start",
-                json={
-                    "service_id": self.config.service_id,
-                    "endpoint": endpoint,
-                    "buyer_id": buyer_id,
-                    "offered_price": offered_price,
-                    "quantity": quantity
-                },
-                timeout=self.config.timeout
+            resp = self._post("/api/negotiate/start", {
+                "service_id": self.config.service_id,
+                "endpoint": endpoint,
+                "buyer_id": buyer_id,
+                "offered_price": offered_price,
+                "quantity": quantity
+            })
+            return json.loads(resp.content)
+        except Exception as e:
+            logger.warning("Negotiation error: %s", e)
+            return {"status": "error", "message": str(e)}
+
+
+class AsyncSentinelEconomicClient:
+    """asyncio twin of SentinelEconomicClient for async gateways (Quart, Starlette, aiohttp)"""
+    
+    def __init__(self, config: SentinelEconomicConfig = None):
+        self.config = config or SentinelEconomicConfig()
+        self.base_url = self.config.base_url.rstrip('/')
+        self._session = None
+        self._gateway_supported = True
+    
+    async def _get_session(self):
+        """Create the aiohttp session on first use, inside the running loop"""
+        if self._session is None or self._session.closed:
+            import aiohttp
+            
+            self._session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=self.config.timeout),
+                connector=aiohttp.TCPConnector(limit=50),
+                headers={"User-Agent": "sentinel-economic-sdk"}
             )
-            return resp.json()
+        return self._session
+    
+    async def _post(self, path: str, payload: Dict):
+        """POST JSON, returning (status, body); body is None if not JSON"""
+        session = await self._get_session()
+        async with session.post(f"{self.base_url}{path}", json=payload) as resp:
+            try:
+                body = await resp.json(content_type=None)
+            except ValueError:
+                body = None
+            return resp.status, body
+    
+    async def close(self):
+        """Close pooled connections"""
+        if self._session is not None:
+            await self._session.close()
+    
+    async def __aenter__(self):
+        return self
+    
+    async def __aexit__(self, *exc):
+        await self.close()
+    
+    async def get_price(self, endpoint: str, use_dynamic: bool = True) -> float:
+        """Get price for an endpoint"""
+        try:
+            status, body = await self._post("/api/pricing/calculate", {
+                "service_id": self.config.service_id,
+                "endpoint": endpoint,
+                "use_dynamic": use_dynamic
+            })
+            if status == 200 and body:
+                return body.get("price", 0.01)
+        except Exception as e:
+            logger.warning("Price fetch error: %s", e)
+        return 0.01  # Default fallback
+    
+    async def get_payment_requirements(self, endpoint: str, method: str = "GET") -> Dict:
+        """Get 402 payment requirements"""
+        try:
+            status, body = await self._post("/api/payment/requirements", {
+                "service_id": self.config.service_id,
+                "endpoint": endpoint,
+                "method": method
+            })
+            if status == 200 and body:
+                return body
         except Exception as e:
-            print(f"[SentinelEconomic] Negotiation error: {e}")
-        return {"status": "error", "message": str(e)}
+            logger.warning("Payment requirements error: %s", e)
+        return {}
+    
+    async def verify_payment(self, endpoint: str, payment_header: str) -> Dict:
+        """Verify x402 payment"""
+        try:
+            _, body = await self._post("/api/payment/verify", {
+                "service_id": self.config.service_id,
+                "endpoint": endpoint,
+                "payment": payment_header
+            })
+            return body or {"success": False, "message": "Invalid response"}
+        except Exception as e:
+            logger.warning("Payment verify error: %s", e)
+            return {"success": False, "message": str(e)}
+    
+    async def verify_token_holder(self, wallet_address: str) -> Dict:
+        """Verify token holder for free access"""
+        try:
+            _, body = await self._post("/api/payment/verify-token", {
+                "service_id": self.config.service_id,
+                "wallet_address": wallet_address
+            })
+            return body or {"success": False, "message": "Invalid response"}
+        except Exception as e:
+            logger.warning("Token verify error: %s", e)
+            return {"success": False, "message": str(e)}
+    
+    async def authorize(self, endpoint: str, method: str = "GET", wallet_address: str = None,
+                        payment_header: str = None) -> Dict:
+        """Same contract as SentinelEconomicClient.authorize()"""
+        if self._gateway_supported:
+            try:
+                status, body = await self._post("/api/gateway/authorize", {
+                    "service_id": self.config.service_id,
+                    "endpoint": endpoint,
+                    "method": method,
+                    "wallet_address": wallet_address,
+                    "payment": payment_header
+                })
+                if status == 200 and body is not None:
+                    return body
+                if status == 404:
+                    self._gateway_supported = False
+            except Exception as e:
+                logger.warning("Authorize error: %s", e)
+        
+        # Token check and 402 requirements are independent reads, so run them together.
+        # Payment is verified only after the token check fails, so holders are never charged.
+        result = {"token_holder": None, "payment_result": None, "requirements": None}
+        if wallet_address:
+            if payment_header:
+                result["token_holder"] = await self.verify_token_holder(wallet_address)
+            else:
+                result["token_holder"], result["requirements"] = await asyncio.gather(
+                    self.verify_token_holder(wallet_address),
+                    self.get_payment_requirements(endpoint, method)
+                )
+            if result["token_holder"].get("success"):
+                result["requirements"] = None
+                return result
+        if payment_header:
+            result["payment_result"] = await self.verify_payment(endpoint, payment_header)
+            return result
+        if result["requirements"] is None:
+            result["requirements"] = await self.get_payment_requirements(endpoint, method)
+        return result
+
+
+# One client (and connection pool) per economic API + service
+_CLIENT_CACHE: Dict[Tuple[str, str], SentinelEconomicClient] = {}
+_CLIENT_CACHE_LOCK = threading.Lock()
+
+
+def get_client(service_id: str, economic_url: str = "http://localhost:8100") -> SentinelEconomicClient:
+    """Get the shared client for a service"""
+    key = (economic_url, service_id)
+    client = _CLIENT_CACHE.get(key)
+    if client is None:
+        with _CLIENT_CACHE_LOCK:
+            client = _CLIENT_CACHE.get(key)
+            if client is None:
+                client = SentinelEconomicClient(SentinelEconomicConfig(
+                    base_url=economic_url,
+                    service_id=service_id
+                ))
+                _CLIENT_CACHE[key] = client
+    return client
 
 
 def sentinel_economic_protected(service_id: str, 
@@ -147,32 +456,35 @@ def sentinel_economic_protected(service_id: str,
         def get_signal(slug):
             return jsonify({"signal": "BUY_YES"})
     """
+    client = get_client(service_id, economic_url)
+    # Everything that is fixed per service is resolved once, not per request
+    authorize = client.authorize
+    negotiate_url = f"{economic_url}/api/negotiate/start"
+    # Serialized 402 bodies per (endpoint, method); refreshed with the requirements cache
+    payment_required_cache = _TTLCache()
     
     def decorator(f):
         @wraps(f)
         def decorated_function(*args, **kwargs):
-            client = SentinelEconomicClient(SentinelEconomicConfig(
-                base_url=economic_url,
-                service_id=service_id
-            ))
+            headers = request.headers
+            # Header lookups are case-insensitive, so this also matches X-PAYMENT
+            wallet = headers.get('X-Wallet-Address')
+            payment_header = headers.get('X-Payment')
             
-            endpoint = request.path
-            method = request.method
+            # Token holder, payment and 402 requirements in one backend call
+            auth = authorize(request.path, request.method, wallet, payment_header)
             
             # Check 1: Token holder (FREE access)
-            wallet = request.headers.get('X-Wallet-Address')
-            if wallet:
-                token_result = client.verify_token_holder(wallet)
-                if token_result.get("success"):
-                    response = f(*args, **kwargs)
-                    if isinstance(response, Response):
-                        response.headers['X-Access-Method'] = 'token_holder'
-                    return response
+            token_result = auth.get("token_holder") or {}
+            if token_result.get("success"):
+                response = f(*args, **kwargs)
+                if isinstance(response, Response):
+                    response.headers['X-Access-Method'] = 'token_holder'
+                return response
             
             # Check 2: x402 Payment
-            payment_header = request.headers.get('X-Payment') or request.headers.get('X-PAYMENT')
-            if payment_header:
-                verify_result = client.verify_payment(endpoint, payment_header)
+            verify_result = auth.get("payment_result")
+            if verify_result is not None:
                 if verify_result.get("success"):
                     response = f(*args, **kwargs)
                     if isinstance(response, Response):
@@ -180,31 +492,32 @@ def sentinel_economic_protected(service_id: str,
                         response.headers['X-Payment-Status'] = 'settled'
                     return response
                 else:
-                    return jsonify({
+                    return Response(json.dumps({
                         "error": "Payment verification failed",
                         "details": verify_result.get("message")
-                    }), 402
+                    }), status=402, mimetype="application/json")
             
             # Check 3: Negotiation token (if negotiated price)
-            neg_token = request.headers.get('X-Negotiation-Token')
-            if neg_token:
-                # TODO: Verify negotiation was accepted and paid
-                pass
+            # TODO: Verify X-Negotiation-Token was accepted and paid
             
             # No valid payment - return 402
-            payment_req = client.get_payment_requirements(endpoint, method)
+            key = (request.path, request.method)
+            body = payment_required_cache.get(key)
+            if body is None:
+                payment_req = auth.get("requirements") or {}
+                body = json.dumps({
+                    "error": "Payment required",
+                    "price": payment_req.get("price"),
+                    "currency": payment_req.get("currency", "USDC"),
+                    "payment_methods": payment_req.get("payment_methods", []),
+                    "negotiate_url": negotiate_url,
+                    "expires_at": payment_req.get("expires_at")
+                }).encode()
+                if payment_req:
+                    payment_required_cache.set(key, body, CACHE_TTL)
             
-            response = jsonify({
-                "error": "Payment required",
-                "price": payment_req.get("price"),
-                "currency": payment_req.get("currency", "USDC"),
-                "payment_methods": payment_req.get("payment_methods", []),
-                "negotiate_url": f"{economic_url}/api/negotiate/start",
-                "expires_at": payment_req.get("expires_at")
-            })
-            response.status_code = 402
-            response.headers['WWW-Authenticate'] = 'X402'
-            return response
+            return Response(body, status=402, mimetype="application/json",
+                            headers={"WWW-Authenticate": "X402"})
         
         return decorated_function
     return decorator
@@ -11,11 +11,23 @@ from datetime import datetime, UTC
 DB_PATH = os.path.expanduser("~/sentinel-economic/data/sentinel_economic.db")
 
 
+def get_connection() -> sqlite3.Connection:
+    """Open the database with WAL and the shared PRAGMA settings"""
+    conn = sqlite3.connect(DB_PATH)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA mmap_size=268435456")
+    conn.execute("PRAGMA cache_size=-65536")
+    return conn
+
+
 def setup_database():
     """Create all tables for Sentinel Economic"""
     
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
     
     # ═══════════════════════════════════════════════════════════════
     # USERS TABLE
@@ -170,7 +182,12 @@ def setup_database():
     cursor.execute("CREATE INDEX IF NOT EXISTS idx_services_owner ON services(owner_id)")
     cursor.execute("CREATE INDEX IF NOT EXISTS idx_services_status ON services(status)")
     cursor.execute("CREATE INDEX IF NOT EXISTS idx_services_category ON services(category)")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_endpoints_service ON service_endpoints(service_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_services_status_cat ON services(status, category, featured DESC)")
+    # Covering index: per-service endpoint/price reads never touch the table
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_endpoints_lookup ON service_endpoints
+        (service_id, method, endpoint, base_price, dynamic_pricing_enabled, rate_limit)
+    """)
     cursor.execute("CREATE INDEX IF NOT EXISTS idx_notifications_user ON notifications(user_id, read)")
     cursor.execute("CREATE INDEX IF NOT EXISTS idx_transactions_seller ON transactions(seller_id)")
     cursor.execute("CREATE INDEX IF NOT EXISTS idx_transactions_buyer ON transactions(buyer_id)")
@@ -186,8 +203,6 @@ def setup_database():
 def seed_demo_data():
     """Add demo data for testing"""
     
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
     now = datetime.now(UTC).isoformat()
     
     # Demo users
@@ -197,38 +212,21 @@ def seed_demo_data():
         ("user_bob", "B0bBuyerWa11etAddress1234567890abcdefghij", "Bob (Research Agent)", "buyer", now),
     ]
     
-    for user in demo_users:
-        try:
-            cursor.execute("""
-                INSERT INTO users (id, wallet_address, display_name, role, created_at)
-                VALUES (?, ?, ?, ?, ?)
-            """, user)
-        except sqlite3.IntegrityError:
-            pass
-    
     # Demo service
-    try:
-        cursor.execute("""
-            INSERT INTO services 
-            (id, owner_id, name, slug, description, base_url, treasury_wallet, 
-             negotiation_mode, tags, category, status, created_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
-            "svc_oracle_sentinel",
-            "user_edu",
-            "Oracle Sentinel Predict",
-            "oracle-sentinel",
-            "AI-powered prediction market intelligence with 57% accuracy. Get real-time signals, probability estimates, and trading recommendations.",
-            "https://api.oraclesentinel.xyz",
-            "LXzWaDDkSkDQSAvRfArcYwRSq2pjgrVFidGbbnWbiD9",
-            "auto",
-            "prediction,oracle,trading,ai",
-            "api",
-            "active",
-            now
-        ))
-    except sqlite3.IntegrityError:
-        pass
+    demo_service = (
+        "svc_oracle_sentinel",
+        "user_edu",
+        "Oracle Sentinel Predict",
+        "oracle-sentinel",
+        "AI-powered prediction market intelligence with 57% accuracy. Get real-time signals, probability estimates, and trading recommendations.",
+        "https://api.oraclesentinel.xyz",
+        "LXzWaDDkSkDQSAvRfArcYwRSq2pjgrVFidGbbnWbiD9",
+        "auto",
+        "prediction,oracle,trading,ai",
+        "api",
+        "active",
+        now
+    )
     
     # Demo endpoints
     demo_endpoints = [
@@ -239,17 +237,26 @@ def seed_demo_data():
         ("svc_oracle_sentinel", "POST", "/api/v1/analyze", "Custom market analysis", 0.05),
     ]
     
-    for ep in demo_endpoints:
-        try:
-            cursor.execute("""
-                INSERT INTO service_endpoints 
-                (service_id, method, endpoint, description, base_price, created_at)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (*ep, now))
-        except sqlite3.IntegrityError:
-            pass
-    
-    conn.commit()
+    # One transaction: committed on success, rolled back if any insert fails.
+    # INSERT OR IGNORE makes re-seeding an existing database a no-op.
+    conn = get_connection()
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.executemany("""
+            INSERT OR IGNORE INTO users (id, wallet_address, display_name, role, created_at)
+            VALUES (?, ?, ?, ?, ?)
+        """, demo_users)
+        conn.execute("""
+            INSERT OR IGNORE INTO services 
+            (id, owner_id, name, slug, description, base_url, treasury_wallet, 
+             negotiation_mode, tags, category, status, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, demo_service)
+        conn.executemany("""
+            INSERT OR IGNORE INTO service_endpoints 
+            (service_id, method, endpoint, description, base_price, created_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, [(*ep, now) for ep in demo_endpoints])
     conn.close()
     
     print("✅ Demo data seeded successfully")
@@ -4,25 +4,134 @@ Token Gating - Check $OSAI balance for free API access
 """
 
 import json
+import logging
 import os
+import threading
+from collections import OrderedDict
+from functools import lru_cache
 from solana.rpc.api import Client
-from solana.rpc.types import TokenAccountOpts
+from solana.rpc.core import RPCException
 from solders.pubkey import Pubkey
 import time
 
-# Simple cache for token balances (wallet -> (balance, timestamp))
-_balance_cache = {}
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("token_gating")
+
+# LRU cache for token balances ((wallet, mint) -> (balance, timestamp))
+_balance_cache = OrderedDict()
+_balance_cache_lock = threading.Lock()
 CACHE_TTL = 60  # Cache for 60 seconds
+CACHE_MAX_SIZE = 10_000  # Oldest-used entries are evicted beyond this
+
+
+def _cache_get(key):
+    """Return a fresh cached balance, or None"""
+    with _balance_cache_lock:
+        entry = _balance_cache.get(key)
+        if entry is None:
+            return None
+        if time.time() - entry[1] >= CACHE_TTL:
+            return None  # kept as a fallback for RPC outages
+        _balance_cache.move_to_end(key)
+        return entry[0]
+
+
+def _cache_get_stale(key):
+    """Return the last known balance regardless of age, or None"""
+    with _balance_cache_lock:
+        entry = _balance_cache.get(key)
+        return entry[0] if entry is not None else None
+
+
+def _cache_put(key, balance: int):
+    """Store a balance, evicting the least recently used entry when full"""
+    with _balance_cache_lock:
+        _balance_cache[key] = (balance, time.time())
+        _balance_cache.move_to_end(key)
+        if len(_balance_cache) > CACHE_MAX_SIZE:
+            _balance_cache.popitem(last=False)
 
 # Load config
 CONFIG_PATH = os.path.join(os.path.dirname(__file__), '..', 'config', 'x402_config.json')
 
+# Parsed config, reloaded only when the file's mtime changes: (mtime, config)
+_config_cache = (None, None)
+
 def load_config() -> dict:
-    with open(CONFIG_PATH, 'r') as f:
-        return json.load(f)
+    global _config_cache
+    mtime = os.stat(CONFIG_PATH).st_mtime_ns
+    cached_mtime, config = _config_cache
+    if cached_mtime != mtime:
+        with open(CONFIG_PATH, 'r') as f:
+            config = json.load(f)
+        _config_cache = (mtime, config)
+    return config
 
 # Solana RPC
 SOLANA_RPC = "https://api.mainnet-beta.solana.com"
+SOLANA_RPC_TIMEOUT = 5  # seconds
+SOLANA_RPC_HEADERS = {"User-Agent": "sentinel-economic/1"}
+
+# SPL token account layouts used for batched balance reads
+TOKEN_PROGRAM_ID = Pubkey.from_string("TokenkegQfeZyiNwAJbNbGKPFXCWuBvf9Ss623VQ5DA")
+ASSOCIATED_TOKEN_PROGRAM_ID = Pubkey.from_string("ATokenGPvbdGVxr1b2hvZbsiqW5xWH25efTNsLJA8knL")
+TOKEN_AMOUNT_OFFSET = 64  # u64 little-endian after mint (32) + owner (32)
+MINT_DECIMALS_OFFSET = 44  # u8 after mint authority option (36) + supply (8)
+MAX_ACCOUNTS_PER_CALL = 100  # getMultipleAccounts limit
+
+# Mint decimals never change, so each mint is looked up once
+_mint_decimals = {}
+
+# Base58 without 0, O, I, l; pubkeys encode to 32-44 characters
+BASE58_ALPHABET = frozenset("123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz")
+
+
+def _looks_like_pubkey(address: str) -> bool:
+    """Cheap shape check before handing an address to Pubkey.from_string"""
+    return 32 <= len(address) <= 44 and BASE58_ALPHABET.issuperset(address)
+
+
+@lru_cache(maxsize=1024)
+def _is_valid_pubkey(address: str) -> bool:
+    """Check that an address parses as a Solana pubkey (memoized for repeat callers)"""
+    if not _looks_like_pubkey(address):
+        return False
+    try:
+        Pubkey.from_string(address)
+        return True
+    except Exception:
+        return False
+
+
+@lru_cache(maxsize=32)
+def _mint_pubkey(mint_address: str) -> Pubkey:
+    """Parse a mint address once; the configured mints rarely change"""
+    return Pubkey.from_string(mint_address)
+
+# Shared RPC client; its HTTP connection pool is reused across lookups
+_solana_client = None
+_solana_client_lock = threading.Lock()
+
+
+def get_solana_client() -> Client:
+    """Get the shared Solana RPC client, creating it on first use"""
+    global _solana_client
+    if _solana_client is None:
+        with _solana_client_lock:
+            if _solana_client is None:
+                _solana_client = Client(SOLANA_RPC, timeout=SOLANA_RPC_TIMEOUT,
+                                        extra_headers=SOLANA_RPC_HEADERS)
+    return _solana_client
+
+
+def _associated_token_address(wallet_pubkey: Pubkey, mint_pubkey: Pubkey) -> Pubkey:
+    """Derive a wallet's associated token account for a mint (no RPC)"""
+    address, _ = Pubkey.find_program_address(
+        [bytes(wallet_pubkey), bytes(TOKEN_PROGRAM_ID), bytes(mint_pubkey)],
+        ASSOCIATED_TOKEN_PROGRAM_ID
+    )
+    return address
+
 
 def get_token_balance(wallet_address: str, mint_address: str) -> int:
     """
@@ -31,59 +140,129 @@ def get_token_balance(wallet_address: str, mint_address: str) -> int:
     Uses caching to avoid RPC rate limits.
     """
     # Check cache first
-    cache_key = f"{wallet_address}:{mint_address}"
-    if cache_key in _balance_cache:
-        cached_balance, cached_time = _balance_cache[cache_key]
-        if time.time() - cached_time < CACHE_TTL:
-            return cached_balance
+    cache_key = (wallet_address, mint_address)
+    cached_balance = _cache_get(cache_key)
+    if cached_balance is not None:
+        return cached_balance
     
     try:
-        client = Client(SOLANA_RPC)
+        client = get_solana_client()
         
         wallet_pubkey = Pubkey.from_string(wallet_address)
-        mint_pubkey = Pubkey.from_string(mint_address)
+        mint_pubkey = _mint_pubkey(mint_address)
         
-        # Use TokenAccountOpts object instead of dict
-        opts = TokenAccountOpts(mint=mint_pubkey)
+        # Point lookup on the wallet's associated token account
+        ata = _associated_token_address(wallet_pubkey, mint_pubkey)
+        try:
+            token_amount = client.get_token_account_balance(ata).value
+        except RPCException as e:
+            if "could not find account" not in str(e):
+                raise
+            # No token account - cache zero balance
+            _cache_put(cache_key, 0)
+            return 0
         
-        response = client.get_token_accounts_by_owner_json_parsed(
-            wallet_pubkey,
-            opts
-        )
+        _mint_decimals[mint_pubkey] = token_amount.decimals
         
-        if response.value and len(response.value) > 0:
-            token_account = response.value[0]
-            account_data = token_account.account.data
+        # Return human-readable balance
+        human_balance = int(token_amount.amount) // (10 ** token_amount.decimals)
+        # Cache the result
+        _cache_put(cache_key, human_balance)
+        return human_balance
+        
+    except Exception as e:
+        logger.warning("Error checking balance: %s", e)
+        # Transient RPC failure (rate limit, 5xx, timeout): don't revoke
+        # access on a flap, fall back to the last balance we saw
+        stale_balance = _cache_get_stale(cache_key)
+        return stale_balance if stale_balance is not None else 0
+
+
+def get_token_balances(wallet_addresses: list, mint_address: str) -> dict:
+    """
+    Get SPL token balances for many wallets at once.
+    Reads each wallet's associated token account with batched
+    getMultipleAccounts calls. Returns {wallet: human-readable balance}.
+    """
+    balances = {}
+    pending = {}  # wallet -> ATA pubkey
+    mint_pubkey = _mint_pubkey(mint_address)
+    
+    for wallet in dict.fromkeys(wallet_addresses):
+        cached_balance = _cache_get((wallet, mint_address))
+        if cached_balance is not None:
+            balances[wallet] = cached_balance
+            continue
+        if not _looks_like_pubkey(wallet):
+            balances[wallet] = 0  # Invalid wallet address
+            continue
+        try:
+            pending[wallet] = _associated_token_address(Pubkey.from_string(wallet), mint_pubkey)
+        except Exception:
+            balances[wallet] = 0  # Invalid wallet address
+    
+    if not pending:
+        return balances
+    
+    client = get_solana_client()
+    wallets = list(pending)
+    decimals = None
+    
+    try:
+        for start in range(0, len(wallets), MAX_ACCOUNTS_PER_CALL - 1):
+            chunk = wallets[start:start + MAX_ACCOUNTS_PER_CALL - 1]
+            keys = [pending[w] for w in chunk]
+            if decimals is None:
+                decimals = _mint_decimals.get(mint_pubkey)
+            if decimals is None:
+                keys.append(mint_pubkey)  # read decimals in the same call
+            accounts = client.get_multiple_accounts(keys).value
             
-            # Handle different response formats
-            if hasattr(account_data, 'parsed'):
-                parsed = account_data.parsed
-            elif isinstance(account_data, dict) and 'parsed' in account_data:
-                parsed = account_data['parsed']
-            else:
-                print(f"[TokenGating] Unexpected data format: {type(account_data)}")
-                return 0
+            if decimals is None:
+                mint_account = accounts.pop()
+                decimals = mint_account.data[MINT_DECIMALS_OFFSET] if mint_account else 6
+                _mint_decimals[mint_pubkey] = decimals
             
-            # Get token amount info
-            if isinstance(parsed, dict) and 'info' in parsed:
-                info = parsed['info']
-                token_amount = info.get('tokenAmount', {})
-                balance = int(token_amount.get('amount', 0))
-                decimals = int(token_amount.get('decimals', 6))
-                
-                # Return human-readable balance
-                human_balance = balance // (10 ** decimals)
-                # Cache the result
-                _balance_cache[cache_key] = (human_balance, time.time())
-                return human_balance
-        
-        # Cache zero balance
-        _balance_cache[cache_key] = (0, time.time())
-        return 0
-        
+            for wallet, account in zip(chunk, accounts):
+                if account is None:
+                    balances[wallet] = 0  # No token account
+                else:
+                    data = bytes(account.data)
+                    amount = int.from_bytes(data[TOKEN_AMOUNT_OFFSET:TOKEN_AMOUNT_OFFSET + 8], "little")
+                    balances[wallet] = amount // (10 ** decimals)
+                _cache_put((wallet, mint_address), balances[wallet])
     except Exception as e:
-        print(f"[TokenGating] Error checking balance: {e}")
-        return 0
+        logger.warning("Error batch checking balances: %s", e)
+        # Retry what is left one wallet at a time
+        for wallet in wallets:
+            if wallet not in balances:
+                balances[wallet] = get_token_balance(wallet, mint_address)
+    
+    return balances
+
+
+# Fixed responses for the early-exit paths of check_osai_holder
+_RESP_DISABLED = {
+    "is_holder": False,
+    "balance": 0,
+    "min_required": 0,
+    "tier": "free",
+    "message": "Token gating disabled"
+}
+_RESP_NO_WALLET = {
+    "is_holder": False,
+    "balance": 0,
+    "min_required": 0,  # filled in from config
+    "tier": "free",
+    "message": "No wallet provided"
+}
+_RESP_INVALID = {
+    "is_holder": False,
+    "balance": 0,
+    "min_required": 0,  # filled in from config
+    "tier": "free",
+    "message": "Invalid wallet address"
+}
 
 
 def check_osai_holder(wallet_address: str) -> dict:
@@ -93,37 +272,17 @@ def check_osai_holder(wallet_address: str) -> dict:
     config = load_config()
     
     if not config.get("token_gating", {}).get("enabled", False):
-        return {
-            "is_holder": False,
-            "balance": 0,
-            "min_required": 0,
-            "tier": "free",
-            "message": "Token gating disabled"
-        }
+        return dict(_RESP_DISABLED)
     
     osai_mint = config.get("osai_mint")
     min_balance = config.get("token_gating", {}).get("min_balance", 1000)
     
     if not wallet_address:
-        return {
-            "is_holder": False,
-            "balance": 0,
-            "min_required": min_balance,
-            "tier": "free",
-            "message": "No wallet provided"
-        }
+        return {**_RESP_NO_WALLET, "min_required": min_balance}
     
     # Validate wallet address format
-    try:
-        Pubkey.from_string(wallet_address)
-    except Exception:
-        return {
-            "is_holder": False,
-            "balance": 0,
-            "min_required": min_balance,
-            "tier": "free",
-            "message": "Invalid wallet address"
-        }
+    if not _is_valid_pubkey(wallet_address):
+        return {**_RESP_INVALID, "min_required": min_balance}
     
     # Get balance
     balance = get_token_balance(wallet_address, osai_mint)